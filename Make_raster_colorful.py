@@ -21,6 +21,7 @@ from map_tools.helper import get_map_meta
 init_tif = 'Rasters/lumap_2050_2024_02_17__21_20_52.tiff'
 tif_path = 'Rasters/lucc_separate/Non-Ag_LU_00_Environmental Plantings_2050.tiff'
 NLUM_mask = 'Assests/NLUM_2010-11_mask.tif'
+preview_width = None    # Set to e.g. 1000 for quick-look QA previews
 
 # Get the metadata for map making
 map_meta = get_map_meta()
@@ -72,13 +73,15 @@ for idx, row in map_meta.iterrows():
         if data_type == 'integer':
             center,  bounds_wgs, bounds_mercator = process_int_raster(initial_tif=init_tif, 
                                                                     color_dict=val_color_dict,
-                                                                    map_type_idx=idx)
+                                                                    map_type_idx=idx,
+                                                                    preview_width=preview_width)
 
 
         elif data_type == 'float':
             center, bounds_for_folium, mercator_bbox = process_float_raster(
                                                             initial_tif=tif_path,
-                                                            mask_path=NLUM_mask)
+                                                            mask_path=NLUM_mask,
+                                                            preview_width=preview_width)
 
 
 
@@ -86,18 +89,20 @@ for idx, row in map_meta.iterrows():
 #       Merge processed map with basemap, create png map          #
 ###################################################################
 out_base = os.path.splitext(tif_path)[0]
-in_map_path = f"{out_base}_mercator.tif"
+suffix = '_preview' if preview_width else ''
+in_map_path = f"{out_base}_mercator{suffix}.tif"
 Au_shp = 'Assests\AUS_adm\STE11aAust_mercator_simplified.shp'
 inmap_text = '''Precision Agriculture\nScenario: 1.5℃ (50%)\nYear: 2050'''
 basemap_path = 'Assests/basemap.tif'
-png_out_path = f"{out_base}_mosaic.png"
+png_out_path = f"{out_base}_mosaic{suffix}.png"
 
 create_png_map(tif_path = in_map_path,
                 color_desc_dict = color_desc_dict,
                 basemap_path = basemap_path,
                 shapefile_path = Au_shp,
                 anno_text = inmap_text,
-                save_path = png_out_path)
+                save_path = png_out_path,
+                preview_width = preview_width)
 
 
 ###################################################################
@@ -1,10 +1,13 @@
 import os
+import uuid
 import numpy as np
 import imageio
+from contextlib import contextmanager
 
 import rasterio
 from rasterio.io import MemoryFile
 from rasterio.coords import BoundingBox
+from affine import Affine
 from rasterio.warp import (calculate_default_transform, 
                            transform_bounds, 
                            reproject, 
@@ -53,34 +56,150 @@ def hex_color_to_numeric(hex_color: str, toFloat: bool = False) -> tuple:
     
 
 
-def convert_1band_to_4band_in_memory(initial_tif:str,
+@contextmanager
+def atomic_write_path(path:str):
+    """
+    Yield a temporary path next to `path`, renamed to `path` once the block succeeds.
+
+    Concurrent writers (e.g. workers on several nodes sharing storage) then never 
+    see or leave a partially written file.
+
+    Args:
+        path (str): The final path of the file.
+    """
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}_{uuid.uuid4().hex[:8]}.tmp{ext}"   # Keep the extension for format inference
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_out_shape(width:int, height:int, out_width:int=None) -> tuple:
+    """
+    Get the (height, width) of a raster decimated to a target width, keeping the aspect ratio.
+
+    Args:
+        width (int): The width of the raster.
+        height (int): The height of the raster.
+        out_width (int, optional): The target width. Defaults to None (full resolution).
+
+    Returns:
+        tuple: The output (height, width); never larger than the raster itself.
+    """
+    if out_width is None or out_width >= width:
+        return height, width
+
+    return max(1, round(height * out_width / width)), out_width
+
+
+def read_raster_band(src, 
+                     band:int=1, 
+                     out_width:int=None,
+                     resampling:Resampling=Resampling.nearest) -> tuple:
+    """
+    Read one band and the metadata from a raster source.
+
+    Args:
+        src (str | MemoryFile | StoreSlice):
+            The path for a tif, an in-memory raster, or a slice of a `RasterStore`.
+        band (int, optional):
+            The band number to read. Defaults to 1.
+        out_width (int, optional):
+            Read a decimated array of this width (from overviews when present).
+            Defaults to None (full resolution).
+        resampling (Resampling, optional):
+            The resampling used for decimated reads. Defaults to nearest.
+
+    Returns:
+        tuple: The 2D (HW) array and a copy of the rasterio metadata, matching the array.
+    """
+    if isinstance(src, MemoryFile):
+        ds = src.open()
+    elif isinstance(src, (str, os.PathLike)):
+        ds = rasterio.open(src)
+    else:
+        # A RasterStore slice, only its own chunks are read
+        meta = src.meta.copy()
+        out_shape = get_out_shape(meta['width'], meta['height'], out_width)
+        arr = src.read(band, out_shape=out_shape)
+        ds = None
+
+    if ds is not None:
+        with ds:
+            meta = ds.meta.copy()
+            out_shape = get_out_shape(ds.width, ds.height, out_width)
+            arr = ds.read(band, out_shape=out_shape, resampling=resampling)
+
+    # Scale the transform to the decimated pixel size
+    if out_shape != (meta['height'], meta['width']):
+        meta['transform'] = meta['transform'] * Affine.scale(meta['width'] / out_shape[1], 
+                                                             meta['height'] / out_shape[0])
+        meta.update(height=out_shape[0], width=out_shape[1])
+
+    return arr, meta
+
+
+def get_save_base(src) -> str:
+    """
+    Get the save path (no extension) of the outputs from a raster source.
+
+    Args:
+        src (str | StoreSlice): The path for a tif, or a slice of a `RasterStore`.
+
+    Returns:
+        str: The save path without extension.
+    """
+    # RasterStore slices carry the path of the raster they were built from
+    return os.path.splitext(getattr(src, 'path', src))[0]
+
+
+def colorize_array(arr:np.ndarray, color_dict:dict) -> np.ndarray:
+    """
+    Convert a 1-band (HW) array to a 4-band (RGBA) array with a value-color dictionary.
+
+    Args:
+        arr (np.ndarray): The 2D (HW) array.
+        color_dict (dict): A dictionary of color values for each class.
+
+    Returns:
+        np.ndarray: The 4-band uint8 array (CHW); values without a color are transparent.
+    """
+    arr_4band = np.zeros((arr.shape[0], arr.shape[1], 4), dtype='uint8')
+    for k, v in color_dict.items():
+        arr_4band[arr == k] = v
+
+    return arr_4band.transpose(2, 0, 1)  # Convert HWC to CHW
+
+
+def convert_1band_to_4band_in_memory(initial_tif,
                                      band:int=1, 
-                                     color_dict: dict=None) -> MemoryFile:
+                                     color_dict: dict=None,
+                                     out_width: int=None) -> MemoryFile:
     """Convert a 1-band array in a MemoryFile to 4-band (RGBA) and return a new MemoryFile.
 
     Args:
-        initial_tif (str): 
-                The path for input tif.
+        initial_tif (str | MemoryFile | StoreSlice): 
+                The path for input tif, an in-memory raster, or a slice of a `RasterStore`.
         color_dict (dict): 
                 A dictionary of color values for each class.
+        out_width (int, optional):
+                Decimate the array to this width with mode resampling, so that
+                every output pixel keeps a valid class. Defaults to None (full resolution).
 
     Returns:
         MemoryFile: The new MemoryFile containing the 4-band (RGBA) array.
     """
     
-    with rasterio.open(initial_tif) as src:
-        lu_arr = src.read(band)               # Read the 1-band array, return a 2D array (HW)
-        nodata = src.meta['nodata']
-        color_dict[nodata] = (0, 0, 0, 0)  # Set the color of nodata value to transparent
-        
-        lu_meta = src.meta.copy()
-        lu_meta.update(count=4, compress='lzw', dtype='uint8', nodata=0)
-
-        arr_4band = np.zeros((lu_arr.shape[0], lu_arr.shape[1], 4), dtype='uint8')
-        for k, v in color_dict.items():
-            arr_4band[lu_arr == k] = v
+    lu_arr, lu_meta = read_raster_band(initial_tif, band, out_width, Resampling.mode)   # Read the 1-band array, return a 2D array (HW)
+    nodata = lu_meta['nodata']
+    color_dict[nodata] = (0, 0, 0, 0)  # Set the color of nodata value to transparent
+    
+    lu_meta.update(count=4, compress='lzw', dtype='uint8', nodata=0)
 
-        arr_4band = arr_4band.transpose(2, 0, 1)  # Convert HWC to CHW
+    arr_4band = colorize_array(lu_arr, color_dict)
 
     # Create a new in-memory file for the 4-band array
     memfile = MemoryFile()
@@ -172,24 +291,27 @@ def save_colored_raster_as_png(src_memfile: MemoryFile,
         center = [(wgs84_bbox.bottom + wgs84_bbox.top) / 2,
                   (wgs84_bbox.left + wgs84_bbox.right) / 2]
         
-        imageio.imsave(out_path, img_rgba)
+        with atomic_write_path(out_path) as tmp_path:
+            imageio.imsave(tmp_path, img_rgba)
         
     # Return the center/bounds for folium
     return center, bounds_for_folium, mercator_bbox
 
 # Function to reclassify -> colorfy -> reproject -> toPNG
-def process_int_raster(initial_tif:str=None, 
+def process_int_raster(initial_tif=None, 
                    band=1,
                    map_type_idx:int=None, 
                    color_dict:dict=None,
                    src_crs='EPSG:3857', 
-                   dst_crs='EPSG:4326'):
+                   dst_crs='EPSG:4326',
+                   preview_width:int=None,
+                   save_base:str=None):
     """
     Process a raster file by reclassifying, coloring, and reprojecting it entirely in memory.
     
     Args:
-        initial_tif (str): 
-            Path to the initial raster file.
+        initial_tif (str | StoreSlice): 
+            Path to the initial raster file, or a slice of a `RasterStore`.
         band (int): 
             Band number to process (default is 1).
         map_type_idx (int):
@@ -200,28 +322,35 @@ def process_int_raster(initial_tif:str=None,
             Source coordinate reference system (default is 'EPSG:3857').
         dst_crs (str):
             Destination coordinate reference system (default is 'EPSG:4326').
+        preview_width (int):
+            If given, make a quick-look preview of about this width from a decimated read;
+            the outputs are suffixed with '_preview' (default is None).
+        save_base (str):
+            Path (no extension) of the outputs (default is inferred from initial_tif).
     
     Returns:
         tuple: A tuple containing the center, bounds for folium, and mercator bounding box.
     """
     # Process the raster entirely in memory
-    f = convert_1band_to_4band_in_memory(initial_tif, band, color_dict)
+    f = convert_1band_to_4band_in_memory(initial_tif, band, color_dict, preview_width)
     f = reproject_raster_in_memory(f)
     
     # Infer the save path (no extension) from the initial path
-    save_base = os.path.splitext(initial_tif)[0]
+    save_base = save_base or get_save_base(initial_tif)
+    suffix = '_preview' if preview_width else ''
         
     # Save the reprojected raster as a GeoTIFF file
     with f.open() as src:
         kwargs = src.meta.copy()
         kwargs.update(compress='lzw', dtype='uint8', nodata=None)
-        with rasterio.open(f"{save_base}_mercator_{map_type_idx}.tif", 'w', **kwargs) as dst:
+        with atomic_write_path(f"{save_base}_mercator_{map_type_idx}{suffix}.tif") as tmp_path, \
+             rasterio.open(tmp_path, 'w', **kwargs) as dst:
             for i in range(1, src.count + 1):
                 dst.write(src.read(i), i)
     
     # Save the reprojected raster as a PNG file
     center, bounds_for_folium, mercator_bbox = save_colored_raster_as_png(f, 
-                                                    f"{save_base}_mercator_{map_type_idx}.png", 
+                                                    f"{save_base}_mercator_{map_type_idx}{suffix}.png", 
                                                     src_crs, 
                                                     dst_crs)
     
@@ -236,31 +365,31 @@ def process_int_raster(initial_tif:str=None,
 ###################################################################
 
 
-def float_img_to_int(tif_path: str, 
-                    band: int = 1):
+def float_img_to_int(tif_path, 
+                    band: int = 1,
+                    out_width: int = None):
     """
     Converts a floating-point image to an integer image.
 
     Args:
-        tif_path (str): The path to the input TIFF file.
+        tif_path (str | StoreSlice): The path to the input TIFF file, or a slice of a `RasterStore`.
         band (int, optional): The band number to read from the TIFF file. Defaults to 1.
+        out_width (int, optional): Decimate the image to this width. Defaults to None (full resolution).
 
     Returns:
         MemoryFile: The in-memory file containing the converted integer image.
     """
-    with rasterio.open(tif_path) as src:
-        src_arr = src.read(band)
-        src_arr = (src_arr * 100).astype(np.int16)
-        
-        meta = src.meta.copy()
-        meta.update(compress='lzw')
+    src_arr, meta = read_raster_band(tif_path, band, out_width)
+    src_arr = (src_arr * 100).astype(np.int16)
+    
+    meta.update(compress='lzw')
 
-        # Create an in-memory file
-        memfile = MemoryFile()
-        with memfile.open(**meta) as dst:
-            dst.write(src_arr, band)
-            
-        return memfile
+    # Create an in-memory file
+    memfile = MemoryFile()
+    with memfile.open(**meta) as dst:
+        dst.write(src_arr, band)
+        
+    return memfile
     
 
 def mask_invalid_data(memfile: MemoryFile, 
@@ -270,16 +399,16 @@ def mask_invalid_data(memfile: MemoryFile,
 
     Args:
         memfile (MemoryFile): The input memory file containing the data to be masked.
-        mask_path (str): The path to the mask file.
+        mask_path (str | StoreSlice): The path to the mask file, or a slice of a `RasterStore`.
 
     Returns:
         MemoryFile: The memory file with the invalid data masked.
     """
 
-    with rasterio.open(mask_path) as mask, memfile.open() as src:
-        
+    with memfile.open() as src:
         
-        mask_arr = mask.read(1)
+        # Read the mask at the resolution of the data, which may be a decimated preview
+        mask_arr, _ = read_raster_band(mask_path, 1, src.width)
         mask_arr = mask_arr.astype(np.int16)
         
         # read the 4-band array
@@ -303,12 +432,14 @@ def mask_invalid_data(memfile: MemoryFile,
 
 
 # Function to intify -> colorfy -> reproject -> toPNG
-def process_float_raster(initial_tif:str=None, 
+def process_float_raster(initial_tif=None, 
                    band:int=1,
                    color_dict:dict=None,
-                   mask_path:str=None, 
+                   mask_path=None, 
                    src_crs='EPSG:3857', 
-                   dst_crs='EPSG:4326'):
+                   dst_crs='EPSG:4326',
+                   preview_width:int=None,
+                   save_base:str=None):
     """
     Process a float raster image by converting it to an integer, 
     converting it to a 4-band image, masking invalid data, and 
@@ -316,42 +447,49 @@ def process_float_raster(initial_tif:str=None,
     and a PNG file. Return the center and bounds for folium.
 
     Parameters:
-    initial_tif (str): 
-        Path to the initial float raster image.
+    initial_tif (str | StoreSlice): 
+        Path to the initial float raster image, or a slice of a `RasterStore`.
     band (int, default=1): 
         Band number of the float raster image.
     color_dict (dict): 
         Dictionary mapping values to colors for the 4-band image.
-    mask_path (str): 
-        Path to the mask file for invalid data.
+    mask_path (str | StoreSlice): 
+        Path to the mask file for invalid data, or a slice of a `RasterStore`.
     src_crs (str, default='EPSG:3857'): 
         Source CRS (Coordinate Reference System) of the raster image.
     dst_crs (str, default='EPSG:4326'): 
         Destination CRS for reprojecting the raster image.
+    preview_width (int, default=None):
+        If given, make a quick-look preview of about this width from a decimated read;
+        the outputs are suffixed with '_preview'.
+    save_base (str, default=None):
+        Path (no extension) of the outputs, inferred from initial_tif if not given.
 
     Returns:
     tuple: A tuple containing the center coordinates, bounds for folium, and the mercator bounding box.
     """
     
-    f = float_img_to_int(initial_tif,band)
-    f = convert_1band_to_4band_in_memory(f,color_dict)
+    f = float_img_to_int(initial_tif, band, preview_width)
+    f = convert_1band_to_4band_in_memory(f, color_dict=color_dict)
     f = mask_invalid_data(f, mask_path)
     f = reproject_raster_in_memory(f)
     
     # Infer the save path (no extension) from the initial path
-    save_base = os.path.splitext(initial_tif)[0]
+    save_base = save_base or get_save_base(initial_tif)
+    suffix = '_preview' if preview_width else ''
 
     # Save the reprojected raster as a GeoTIFF file
     with f.open() as src:
         kwargs = src.meta.copy()
         kwargs.update(compress='lzw', dtype='uint8', nodata=None)
-        with rasterio.open(f"{save_base}_mercator.tif", 'w', **kwargs) as dst:
+        with atomic_write_path(f"{save_base}_mercator{suffix}.tif") as tmp_path, \
+             rasterio.open(tmp_path, 'w', **kwargs) as dst:
             for i in range(1, src.count + 1):
                 dst.write(src.read(i), i)
 
     # Save the reprojected raster as a PNG file
     center, bounds_for_folium, mercator_bbox = save_colored_raster_as_png(f, 
-                                                    f"{save_base}_mercator.png", 
+                                                    f"{save_base}_mercator{suffix}.png", 
                                                     src_crs, 
                                                     dst_crs)
 
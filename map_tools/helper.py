@@ -3,18 +3,22 @@ import contextily as ctx
 import matplotlib as mpl
 
 
+from map_tools import atomic_write_path, hex_color_to_numeric
 from map_tools.parameters import (color_types,
                                   data_types,
                                   legend_positions)
 
 
 # Function to download a basemap image
-def download_basemap(bounds_mercator):
+def download_basemap(bounds_mercator,
+                     save_path:str='Assests/basemap.tif'):
     """
     Downloads a basemap image within the specified bounds in Mercator projection.
 
     Args:
         bounds_mercator (mercantile.Bounds): The bounds of the area to download the basemap for.
+        save_path (str): The path to save the basemap. Written atomically, so concurrent
+            downloads never leave a partial file. Default is 'Assests/basemap.tif'.
 
     Returns:
         tuple: A tuple containing the downloaded basemap image and the extent of the image.
@@ -28,14 +32,15 @@ def download_basemap(bounds_mercator):
     xmax = bounds_mercator.right
     ymax = bounds_mercator.top
 
-    base_map, extent = ctx.bounds2raster(xmin,
-                                        ymin, 
-                                        xmax, 
-                                        ymax, 
-                                        path='Assests/basemap.tif',
-                                        source=ctx.providers.OpenStreetMap.Mapnik,
-                                        zoom=7,
-                                        n_connections=8)
+    with atomic_write_path(save_path) as tmp_path:
+        base_map, extent = ctx.bounds2raster(xmin,
+                                            ymin, 
+                                            xmax, 
+                                            ymax, 
+                                            path=tmp_path,
+                                            source=ctx.providers.OpenStreetMap.Mapnik,
+                                            zoom=7,
+                                            n_connections=8)
 
    
 # Function to create value-color dictionary for intergirized raster (0-100) 
@@ -74,6 +79,22 @@ def get_color_dict(color_scheme:str='YlOrRd',
     color_df.to_csv(save_path, index=False)
     
     
+def get_val_color_dict(csv_path:str) -> dict:
+    """
+    Read a value-color(HEX) CSV into a value-color(RGBA) dictionary.
+
+    Parameters:
+    - csv_path (str): 
+        The path of the CSV file with 'lu_code' and 'lu_color_HEX' columns.
+
+    Returns:
+        dict: The value-color(RGBA) dictionary.
+    """
+    color_df = pd.read_csv(csv_path)
+    color_df['lu_color_numeric'] = color_df['lu_color_HEX'].apply(hex_color_to_numeric)
+    return color_df.set_index('lu_code')['lu_color_numeric'].to_dict()
+
+
 def get_map_meta():
     """
     Get the map metadata.
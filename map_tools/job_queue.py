@@ -0,0 +1,409 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+import traceback
+from contextlib import contextmanager
+
+import pandas as pd
+
+from map_tools import (hex_color_to_numeric,
+                       process_float_raster,
+                       process_int_raster)
+from map_tools.helper import download_basemap, get_map_meta, get_val_color_dict
+from map_tools.map_making import create_png_map
+
+
+logger = logging.getLogger(__name__)
+
+
+###################################################################
+#                    Job manifest and queue                       #
+###################################################################
+
+
+def build_manifest(tif_paths: list,
+                   out_dir: str = None,
+                   preview_width: int = None,
+                   root: str = '.') -> list:
+    """
+    Create the render tasks for a list of rasters, one per raster and color table.
+
+    Parameters:
+    tif_paths (list):
+        Paths of the rasters to render.
+    out_dir (str, default=None):
+        Directory of the outputs, mirroring the folders of the rasters below `root`
+        (scenarios reuse file names); next to each raster if not given.
+    preview_width (int, default=None):
+        Render quick-look previews of this width instead of full maps.
+    root (str, default='.'):
+        The directory the rasters' folders are mirrored from into `out_dir`. Keep it 
+        the same for every `add`, so that outputs of different scenarios never collide.
+
+    Returns:
+    list: The tasks, as dictionaries that can be added to a `JobQueue`.
+    """
+    map_meta = get_map_meta()
+    suffix = '_preview' if preview_width else ''
+
+    root = os.path.abspath(root)
+
+    tasks = []
+    for tif_path in tif_paths:
+        name = os.path.splitext(os.path.basename(tif_path))[0]
+        if out_dir:
+            if os.path.commonpath([os.path.abspath(tif_path), root]) != root:
+                raise ValueError(f"'{tif_path}' is not under the root '{root}'")
+            rel_base = os.path.splitext(os.path.relpath(os.path.abspath(tif_path), root))[0]
+            save_base = os.path.join(out_dir, rel_base)
+        else:
+            save_base = os.path.splitext(tif_path)[0]
+
+        # Map types can overlap (e.g. 'Ag_LU' in 'Non-Ag_LU'), render each color table once
+        seen_csv = set()
+        for idx, row in map_meta.iterrows():
+            if row['map_type'] not in name or row['csv_path'] in seen_csv:
+                continue
+            seen_csv.add(row['csv_path'])
+
+            tasks.append({'tif_path': tif_path,
+                          'map_type_idx': int(idx),
+                          'save_base': save_base,
+                          'mosaic_path': f"{save_base}_mosaic_{idx}{suffix}.png",
+                          'anno_text': name,
+                          'preview_width': preview_width})
+    return tasks
+
+
+
+class JobQueue:
+    """
+    A render job queue in a SQLite database on shared storage, needing no external service.
+
+    Workers claim jobs inside an exclusive transaction and keep a lease on them
+    with heartbeats. Jobs whose lease expires (e.g. the node died) are put back
+    in the queue, and failed jobs are retried up to `max_attempts` times.
+
+    The database relies on the file locking of the shared file system and uses
+    the default rollback journal, since WAL does not work over network shares.
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 lease: float = 600,
+                 max_attempts: int = 3):
+        self.db_path = db_path
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+        with self._transaction() as con:
+            con.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               task TEXT NOT NULL UNIQUE,
+                               status TEXT NOT NULL DEFAULT 'pending',
+                               attempts INTEGER NOT NULL DEFAULT 0,
+                               worker TEXT,
+                               heartbeat_at REAL,
+                               started_at REAL,
+                               finished_at REAL,
+                               duration REAL,
+                               result TEXT,
+                               error TEXT)''')
+            con.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)')
+
+    @contextmanager
+    def _transaction(self):
+        """Open a connection and hold the database write lock for the block."""
+        con = sqlite3.connect(self.db_path, timeout=120, isolation_level=None)
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                yield con
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+            con.execute('COMMIT')
+        finally:
+            con.close()
+
+    def add(self, tasks: list) -> int:
+        """
+        Add tasks to the queue, ignoring the ones already in it.
+
+        Raises a ValueError if a task would write the outputs of another raster.
+
+        Returns:
+            int: The number of tasks added.
+        """
+        with self._transaction() as con:
+            # Map each output to the raster it is rendered from
+            owners = {}
+            queued = [json.loads(t) for (t,) in con.execute('SELECT task FROM jobs')]
+            for task in queued + tasks:
+                for out in (task['save_base'], task['mosaic_path']):
+                    tif_path = os.path.abspath(task['tif_path'])
+                    if owners.setdefault(out, tif_path) != tif_path:
+                        raise ValueError(f"'{task['tif_path']}' and '{owners[out]}' both write '{out}'")
+
+            before = con.total_changes
+            con.executemany('INSERT OR IGNORE INTO jobs (task) VALUES (?)',
+                            [(json.dumps(t, sort_keys=True),) for t in tasks])
+            return con.total_changes - before
+
+    def claim(self, worker: str) -> tuple:
+        """
+        Claim the next pending job for a worker.
+
+        Returns:
+            tuple: The job id and the task, or None if no job is pending.
+        """
+        now = time.time()
+        with self._transaction() as con:
+            # Requeue the jobs of lost workers, or give up on them after max_attempts
+            con.execute('''UPDATE jobs SET status = 'failed', error = 'Lease expired', finished_at = ?
+                           WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?''',
+                        (now, now - self.lease, self.max_attempts))
+            con.execute('''UPDATE jobs SET status = 'pending'
+                           WHERE status = 'running' AND heartbeat_at < ?''',
+                        (now - self.lease,))
+
+            job = con.execute('''SELECT id, task FROM jobs WHERE status = 'pending'
+                                 ORDER BY id LIMIT 1''').fetchone()
+            if job is None:
+                return None
+
+            con.execute('''UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?,
+                                           started_at = ?, heartbeat_at = ?, error = NULL
+                           WHERE id = ?''',
+                        (worker, now, now, job[0]))
+
+        return job[0], json.loads(job[1])
+
+    def heartbeat(self, job_id: int, worker: str) -> bool:
+        """
+        Renew the lease of a running job.
+
+        Returns:
+            bool: False if the worker no longer holds the job.
+        """
+        with self._transaction() as con:
+            cur = con.execute('''UPDATE jobs SET heartbeat_at = ?
+                                 WHERE id = ? AND worker = ? AND status = 'running' ''',
+                              (time.time(), job_id, worker))
+            return cur.rowcount == 1
+
+    def complete(self, job_id: int, worker: str, result: dict, duration: float):
+        """Record the result and the timing of a finished job."""
+        with self._transaction() as con:
+            con.execute('''UPDATE jobs SET status = 'done', result = ?, duration = ?, finished_at = ?
+                           WHERE id = ? AND worker = ? AND status = 'running' ''',
+                        (json.dumps(result), duration, time.time(), job_id, worker))
+
+    def fail(self, job_id: int, worker: str, error: str):
+        """Record a failed job, and requeue it if it has attempts left."""
+        with self._transaction() as con:
+            con.execute('''UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                                           error = ?, finished_at = ?
+                           WHERE id = ? AND worker = ? AND status = 'running' ''',
+                        (self.max_attempts, error, time.time(), job_id, worker))
+
+    def status(self) -> dict:
+        """
+        Count the jobs by status.
+
+        Returns:
+            dict: The number of jobs for each status.
+        """
+        with self._transaction() as con:
+            return dict(con.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+
+
+###################################################################
+#                            Workers                              #
+###################################################################
+
+
+def render_task(task: dict,
+                map_meta: pd.DataFrame,
+                basemap_path: str,
+                shapefile_path: str,
+                mask_path: str) -> dict:
+    """
+    Render a task: colorize and reproject the raster, then create the png map.
+
+    Parameters:
+    task (dict):
+        The task created by `build_manifest`.
+    map_meta (pd.DataFrame):
+        The map metadata from `get_map_meta`.
+    basemap_path (str):
+        The path of the basemap, downloaded if it does not exist.
+    shapefile_path (str):
+        The path of the shapefile to overlay.
+    mask_path (str):
+        The path of the mask for float rasters.
+
+    Returns:
+    dict: The center, the bounds and the output paths of the rendered map.
+    """
+    idx = task['map_type_idx']
+    row = map_meta.loc[idx]
+    preview_width = task.get('preview_width')
+    suffix = '_preview' if preview_width else ''
+
+    val_color_dict = get_val_color_dict(row['csv_path'])
+    os.makedirs(os.path.dirname(task['save_base']) or '.', exist_ok=True)
+
+    # Render the intermediates under a per-attempt name, so a requeued job still 
+    # running elsewhere can not delete them; the final png is renamed into place
+    run_base = f"{task['save_base']}.{uuid.uuid4().hex[:8]}"
+    map_suffix = f"_{idx}{suffix}" if row['data_type'] == 'integer' else suffix
+    run_out_base = f"{run_base}_mercator{map_suffix}"
+    out_base = f"{task['save_base']}_mercator{map_suffix}"
+
+    try:
+        if row['data_type'] == 'integer':
+            color_df = pd.read_csv(row['csv_path'])
+            color_desc_dict = dict(zip(color_df['lu_color_HEX'].apply(hex_color_to_numeric),
+                                       color_df['lu_desc']))
+            center, bounds_wgs, bounds_mercator = process_int_raster(initial_tif=task['tif_path'],
+                                                                     color_dict=val_color_dict,
+                                                                     map_type_idx=idx,
+                                                                     preview_width=preview_width,
+                                                                     save_base=run_base)
+        else:
+            color_desc_dict = {}
+            center, bounds_wgs, bounds_mercator = process_float_raster(initial_tif=task['tif_path'],
+                                                                       color_dict=val_color_dict,
+                                                                       mask_path=mask_path,
+                                                                       preview_width=preview_width,
+                                                                       save_base=run_base)
+
+        # The basemap is shared by all workers; it is written atomically so racing downloads are safe
+        if not os.path.exists(basemap_path):
+            download_basemap(bounds_mercator, basemap_path)
+
+        create_png_map(tif_path=f"{run_out_base}.tif",
+                       color_desc_dict=color_desc_dict,
+                       basemap_path=basemap_path,
+                       shapefile_path=shapefile_path,
+                       anno_text=task['anno_text'],
+                       save_path=task['mosaic_path'],
+                       preview_width=preview_width)
+        os.replace(f"{run_out_base}.png", f"{out_base}.png")
+    finally:
+        for path in (f"{run_out_base}.tif", f"{run_out_base}.png"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return {'center': center,
+            'bounds_wgs': bounds_wgs,
+            'bounds_mercator': list(bounds_mercator),
+            'outputs': [f"{out_base}.png", task['mosaic_path']]}
+
+
+def run_worker(queue: JobQueue,
+               basemap_path: str = 'Assests/basemap.tif',
+               shapefile_path: str = 'Assests/AUS_adm/STE11aAust_mercator_simplified.shp',
+               mask_path: str = 'Assests/NLUM_2010-11_mask.tif',
+               worker: str = None,
+               poll_interval: float = 10,
+               exit_when_drained: bool = True):
+    """
+    Claim and render jobs until the queue is drained.
+
+    Parameters:
+    queue (JobQueue):
+        The job queue.
+    basemap_path, shapefile_path, mask_path (str):
+        The shared inputs of `render_task`.
+    worker (str, default=None):
+        The worker name; '<hostname>:<pid>' if not given.
+    poll_interval (float, default=10):
+        Seconds to wait when no job is pending but others are still running.
+    exit_when_drained (bool, default=True):
+        Stop once no job is pending or running, otherwise keep polling.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    map_meta = get_map_meta()
+
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            counts = queue.status()
+            if exit_when_drained and not counts.get('pending') and not counts.get('running'):
+                return
+            time.sleep(poll_interval)
+            continue
+
+        job_id, task = job
+
+        # Keep the lease alive while rendering
+        stop = threading.Event()
+        lost = threading.Event()
+        def beat():
+            while not stop.wait(queue.lease / 3):
+                try:
+                    if not queue.heartbeat(job_id, worker):
+                        lost.set()
+                        return
+                except sqlite3.Error as e:
+                    # e.g. a lock wait timing out on a network share, retry at the next beat
+                    logger.warning("Heartbeat of job %s failed: %r", job_id, e)
+        beat_thread = threading.Thread(target=beat, daemon=True)
+        beat_thread.start()
+
+        start = time.time()
+        error = None
+        try:
+            result = render_task(task, map_meta, basemap_path, shapefile_path, mask_path)
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            stop.set()
+            beat_thread.join()
+
+        # The lease expired and the job was requeued, leave it to its new worker
+        if lost.is_set():
+            logger.warning("Lost the lease of job %s, not recording its result", job_id)
+        elif error is not None:
+            queue.fail(job_id, worker, error)
+        else:
+            queue.complete(job_id, worker, result, time.time() - start)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distribute LUTO map rendering over several nodes.')
+    parser.add_argument('--db', required=True, help='Path of the queue database on shared storage.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = commands.add_parser('add', help='Add rasters to the queue.')
+    add_parser.add_argument('rasters', nargs='+')
+    add_parser.add_argument('--out-dir', default=None)
+    add_parser.add_argument('--preview-width', type=int, default=None)
+    add_parser.add_argument('--root', default='.', help='Directory mirrored into --out-dir; keep it the same for every add.')
+
+    work_parser = commands.add_parser('work', help='Render jobs until the queue is drained.')
+    work_parser.add_argument('--basemap', default='Assests/basemap.tif')
+    work_parser.add_argument('--shapefile', default='Assests/AUS_adm/STE11aAust_mercator_simplified.shp')
+    work_parser.add_argument('--mask', default='Assests/NLUM_2010-11_mask.tif')
+    work_parser.add_argument('--worker', default=None)
+
+    commands.add_parser('status', help='Count the jobs by status.')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.db)
+    if args.command == 'add':
+        print(f"Added {queue.add(build_manifest(args.rasters, args.out_dir, args.preview_width, args.root))} jobs")
+    elif args.command == 'work':
+        run_worker(queue, args.basemap, args.shapefile, args.mask, args.worker)
+    else:
+        print(queue.status())
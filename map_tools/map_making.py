@@ -8,6 +8,8 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib_scalebar.scalebar import ScaleBar
 
+from map_tools import atomic_write_path
+
 
 
 
@@ -16,7 +18,8 @@ def create_png_map(tif_path: str,
                   basemap_path: str, 
                   shapefile_path: str,
                   anno_text: str, 
-                  save_path: str):
+                  save_path: str,
+                  preview_width: int = None):
     """
     Creates a mosaic of a raster image with a basemap, overlays a shapefile, and adds scale bar, north arrow, and legend.
 
@@ -33,17 +36,29 @@ def create_png_map(tif_path: str,
         The annotation text to be displayed on the mosaic.
     save_path (str): 
         The file path to save the resulting image.
+    preview_width (int, optional):
+        If given, render a quick-look map of about this width in pixels, 
+        mosaicking at a matching coarse resolution. Defaults to None (300 dpi).
 
     Returns:
     None
     """
     # Create the figure and axis
-    fig, ax = plt.subplots(figsize=(20, 20)) 
+    fig_size = 20
+    fig, ax = plt.subplots(figsize=(fig_size, fig_size)) 
+    
+    # Keep the layout of the full map, only lower the dpi for previews
+    dpi = 300 if preview_width is None else preview_width / fig_size
 
     # Mosaic the raster with the basemap
     with rasterio.open(tif_path) as src, rasterio.open(basemap_path) as base:
+        # Mosaic at no finer than the preview resolution
+        res = None
+        if preview_width is not None:
+            res = max(src.res[0], (src.bounds.right - src.bounds.left) / preview_width)
+            res = (res, res)
         # Mosaic the raster with the basemap
-        mosaic, out_transform = merge([src, base])
+        mosaic, out_transform = merge([src, base], res=res)
     
 
     # Display the mosaic raster
@@ -107,7 +122,8 @@ def create_png_map(tif_path: str,
 
     # Optionally remove axis
     ax.set_axis_off()
-    plt.savefig(save_path, dpi=300, bbox_inches='tight', pad_inches=0)
+    with atomic_write_path(save_path) as tmp_path:
+        plt.savefig(tmp_path, dpi=dpi, bbox_inches='tight', pad_inches=0)
     plt.close(fig)
     
     # Delete the input raster
@@ -0,0 +1,221 @@
+import os
+import re
+import numpy as np
+
+import zarr
+from zarr.codecs import BloscCodec
+
+import rasterio
+from rasterio.crs import CRS
+from affine import Affine
+
+
+
+# LUTO file names end with the year, optionally followed by a run timestamp,
+# e.g. 'Non-Ag_LU_00_Environmental Plantings_2050.tiff' or 'lumap_2050_2024_02_17__21_20_52.tiff'
+LAYER_YEAR_PATTERN = re.compile(r'^(?P<layer>.+?)_(?P<year>\d{4})(?:_|$)')
+
+
+def parse_layer_year(tif_path: str) -> tuple:
+    """
+    Infer the layer name and the year from a LUTO raster file name.
+
+    Args:
+        tif_path (str): The path of the LUTO raster.
+
+    Returns:
+        tuple: The layer name (str) and the year (int).
+    """
+    base = os.path.splitext(os.path.basename(tif_path))[0]
+    match = LAYER_YEAR_PATTERN.match(base)
+    if match is None:
+        raise ValueError(f"Can not infer layer and year from '{tif_path}'")
+
+    return match.group('layer'), int(match.group('year'))
+
+
+
+def build_raster_store(tif_paths: list,
+                       store_path: str,
+                       chunks: tuple = (1024, 1024),
+                       clevel: int = 5) -> 'RasterStore':
+    """
+    Consolidate the GeoTIFFs of a scenario into a chunked, compressed Zarr store.
+
+    The store holds one array per layer with dimensions (year, y, x) and the
+    layer's own dtype and nodata, chunked per year and spatial tile, so that each
+    raster is read once here and only the needed chunks are decompressed afterwards.
+
+    Args:
+        tif_paths (list):
+            Paths of the rasters to consolidate. All rasters must share the same grid.
+        store_path (str):
+            The path of the Zarr store to create (overwritten if it exists).
+        chunks (tuple, optional):
+            The (y, x) chunk size. Defaults to (1024, 1024).
+        clevel (int, optional):
+            The zstd compression level. Defaults to 5.
+
+    Returns:
+        RasterStore: The newly created store.
+    """
+    # Index the rasters by (layer, year), with absolute paths so outputs do not depend on the working directory
+    sources = {}
+    for p in tif_paths:
+        key = parse_layer_year(p)
+        if key in sources:
+            raise ValueError(f"'{p}' and '{sources[key]}' are both ({key[0]}, {key[1]})")
+        sources[key] = os.path.abspath(p)
+    layers = sorted({layer for layer, _ in sources})
+    years = sorted({year for _, year in sources})
+
+    # Get the common grid, and the nodata and dtype of each layer
+    profiles = {}
+    for key, path in sources.items():
+        with rasterio.open(path) as src:
+            profiles[key] = src.profile
+
+    ref = next(iter(profiles.values()))
+    for key, profile in profiles.items():
+        if (profile['width'], profile['height'], profile['transform'], profile['crs']) != \
+           (ref['width'], ref['height'], ref['transform'], ref['crs']):
+            raise ValueError(f"Raster '{sources[key]}' is not on the same grid as the others")
+
+    nodata = {}
+    for layer in layers:
+        layer_nodata = [profiles[k]['nodata'] for k in sources if k[0] == layer]
+        # NaN never equals itself, compare it by name
+        if len({'nan' if v is not None and np.isnan(v) else v for v in layer_nodata}) > 1:
+            raise ValueError(f"Rasters of layer '{layer}' have different nodata values {layer_nodata}")
+        nodata[layer] = layer_nodata[0]
+
+    # Create one (year, y, x) array per layer and write each raster into its year slot;
+    # the years without a raster are never read, so they are left empty
+    group = zarr.open_group(store_path, mode='w')
+    for layer_idx, layer in enumerate(layers):
+        dtype = np.result_type(*[profiles[k]['dtype'] for k in sources if k[0] == layer])
+        data = group.create_array(f"layer_{layer_idx}",
+                                  shape=(len(years), ref['height'], ref['width']),
+                                  chunks=(1, *chunks),
+                                  dtype=dtype,
+                                  fill_value=nodata[layer] if nodata[layer] is not None else 0,
+                                  compressors=BloscCodec(cname='zstd', clevel=clevel, shuffle='bitshuffle'))
+
+        for year_idx, year in enumerate(years):
+            if (layer, year) in sources:
+                with rasterio.open(sources[(layer, year)]) as src:
+                    data[year_idx] = src.read(1).astype(dtype)
+
+    group.attrs.update({
+        'layers': layers,
+        'years': years,
+        'nodata': nodata,
+        'crs': ref['crs'].to_wkt(),
+        'transform': list(ref['transform'])[:6],
+        'sources': {f"{layer}|{year}": path for (layer, year), path in sources.items()}
+    })
+
+    return RasterStore(store_path)
+
+
+
+class RasterStore:
+    """
+    A read-only view of a Zarr store created by `build_raster_store`.
+
+    Use `sel` to get `StoreSlice` objects, which can be passed to
+    `process_int_raster`/`process_float_raster` in place of a GeoTIFF path.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        self.group = zarr.open_group(store_path, mode='r')
+
+        attrs = self.group.attrs
+        self.layers = list(attrs['layers'])
+        self.arrays = {layer: self.group[f"layer_{i}"] for i, layer in enumerate(self.layers)}
+        self.years = [int(y) for y in attrs['years']]
+        self.nodata = dict(attrs['nodata'])
+        self.sources = dict(attrs['sources'])
+        self.crs = CRS.from_wkt(attrs['crs'])
+        self.transform = Affine(*attrs['transform'])
+
+    def sel(self, layer: str = None, year: int = None):
+        """
+        Select the rasters of one layer, one year or both.
+
+        Args:
+            layer (str, optional): The layer name. Defaults to None (all layers).
+            year (int, optional): The year. Defaults to None (all years).
+
+        Returns:
+            StoreSlice | list: A single slice if both layer and year are given,
+                otherwise a list of the existing slices across the unspecified dimension(s).
+        """
+        if layer is not None and year is not None:
+            return StoreSlice(self, layer, year)
+
+        # Skip the layer-year pairs without a source raster
+        layers = self.layers if layer is None else [layer]
+        years = self.years if year is None else [year]
+        return [StoreSlice(self, l, y) for l in layers for y in years
+                if f"{l}|{y}" in self.sources]
+
+
+
+class StoreSlice:
+    """
+    A single (layer, year) raster in a `RasterStore`, read lazily from its chunks.
+    """
+
+    def __init__(self, store: RasterStore, layer: str, year: int):
+        # Only the layer-year pairs built from a raster hold data
+        if f"{layer}|{year}" not in store.sources:
+            raise KeyError(f"({layer}, {year}) is not in '{store.store_path}'")
+
+        self.store = store
+        self.layer = layer
+        self.year = year
+
+        # Outputs are saved next to the original raster
+        self.path = store.sources[f"{layer}|{year}"]
+
+    @property
+    def meta(self) -> dict:
+        """The rasterio metadata of the slice, as if it was read from a GeoTIFF."""
+        data = self.store.arrays[self.layer]
+        return {'driver': 'GTiff',
+                'dtype': str(data.dtype),
+                'nodata': self.store.nodata[self.layer],
+                'width': data.shape[2],
+                'height': data.shape[1],
+                'count': 1,
+                'crs': self.store.crs,
+                'transform': self.store.transform}
+
+    def read(self, band: int = 1, out_shape: tuple = None) -> np.ndarray:
+        """
+        Read the slice into a 2D array, touching only its own chunks.
+
+        Args:
+            band (int, optional): Kept for compatibility with rasterio; must be 1.
+            out_shape (tuple, optional): The (height, width) to decimate to with
+                nearest sampling. Defaults to None (full resolution).
+
+        Returns:
+            np.ndarray: The 2D (HW) array.
+        """
+        if band != 1:
+            raise ValueError("A store slice has a single band")
+
+        data = self.store.arrays[self.layer]
+        year_idx = self.store.years.index(self.year)
+        height, width = data.shape[1:]
+
+        if out_shape is None or tuple(out_shape) == (height, width):
+            return data[year_idx]
+
+        # Sample the pixel nearest to the center of each output pixel
+        rows = ((np.arange(out_shape[0]) + 0.5) * height / out_shape[0]).astype(int)
+        cols = ((np.arange(out_shape[1]) + 0.5) * width / out_shape[1]).astype(int)
+        return data.oindex[year_idx, rows, cols]
@@ -0,0 +1,458 @@
+import os
+import math
+import stat
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import numpy as np
+import pandas as pd
+import imageio
+
+import rasterio
+from rasterio.windows import Window, from_bounds as window_from_bounds
+from rasterio.transform import from_bounds as transform_from_bounds
+from rasterio.warp import transform_bounds, reproject, Resampling
+from affine import Affine
+
+from map_tools import atomic_write_path, colorize_array
+from map_tools.helper import get_map_meta, get_val_color_dict
+
+
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+WEB_MERCATOR_EXTENT = 20037508.342789244   # Half the width of the EPSG:3857 world
+
+
+def tile_bounds_mercator(z: int, x: int, y: int) -> tuple:
+    """
+    Get the EPSG:3857 bounds of a z/x/y (XYZ/slippy) tile.
+
+    Returns:
+        tuple: The (left, bottom, right, top) bounds in meters.
+    """
+    size = 2 * WEB_MERCATOR_EXTENT / 2 ** z
+    left = -WEB_MERCATOR_EXTENT + x * size
+    top = WEB_MERCATOR_EXTENT - y * size
+    return left, top - size, left + size, top
+
+
+def render_tile(tif_path: str,
+                z: int, x: int, y: int,
+                color_dict: dict,
+                data_type: str = 'integer',
+                band: int = 1,
+                mask_path: str = None) -> bytes:
+    """
+    Render a single EPSG:3857 tile of a raster as PNG bytes.
+
+    Only the window of the source covering the tile is read, decimated to
+    about the tile resolution, then reprojected and colorized.
+
+    Args:
+        tif_path (str):
+            Path to the source raster.
+        z, x, y (int):
+            The tile coordinates.
+        color_dict (dict):
+            Dictionary mapping pixel values to colors.
+        data_type (str, optional):
+            'integer' or 'float'; float rasters are scaled by 100 before colorizing
+            as in `process_float_raster`. Defaults to 'integer'.
+        band (int, optional):
+            Band number to render. Defaults to 1.
+        mask_path (str, optional):
+            Path to the mask for invalid data, on the grid of the source; applied to
+            float rasters as in `process_float_raster`. Defaults to None.
+
+    Returns:
+        bytes: The PNG encoded RGBA tile.
+    """
+    dst_bounds = tile_bounds_mercator(z, x, y)
+    tile = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype='uint8')
+
+    with rasterio.open(tif_path) as src:
+        nodata = src.nodata
+
+        # Get the source window covering the tile, snapped outwards to whole pixels
+        src_bounds = transform_bounds('EPSG:3857', src.crs, *dst_bounds)
+        window = window_from_bounds(*src_bounds, transform=src.transform)
+        col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+        window = Window(col_off, 
+                        row_off,
+                        math.ceil(window.col_off + window.width) - col_off,
+                        math.ceil(window.row_off + window.height) - row_off)
+
+        # Tiles outside the raster are fully transparent
+        if not _window_overlaps(window, src):
+            return imageio.imwrite('<bytes>', tile, format='png')
+        window = window.intersection(Window(0, 0, src.width, src.height))
+
+        # Read at no more than twice the tile resolution (uses overviews when present)
+        out_h = min(int(window.height), 2 * TILE_SIZE)
+        out_w = min(int(window.width), 2 * TILE_SIZE)
+        arr = src.read(band, window=window, out_shape=(out_h, out_w), resampling=Resampling.nearest)
+        src_transform = src.window_transform(window) * Affine.scale(window.width / out_w,
+                                                                    window.height / out_h)
+        src_crs = src.crs
+
+    # Valid source pixels; only mask nodata when the raster defines it, 0 is a real class
+    src_valid = np.ones((out_h, out_w), dtype='uint8')
+    if nodata is not None:
+        src_valid[np.isnan(arr) if np.isnan(nodata) else arr == nodata] = 0
+
+    # Mask the invalid data of float rasters, as `mask_invalid_data` does
+    if data_type == 'float' and mask_path is not None:
+        with rasterio.open(mask_path) as mask:
+            mask_arr = mask.read(1, window=window, out_shape=(out_h, out_w), resampling=Resampling.nearest)
+        src_valid[mask_arr == -9999] = 0
+
+    # Reproject just this tile to EPSG:3857; pixels outside the source stay invalid
+    dst_arr = np.zeros((TILE_SIZE, TILE_SIZE), dtype=arr.dtype)
+    valid = np.zeros((TILE_SIZE, TILE_SIZE), dtype='uint8')
+    for source, destination in ((arr, dst_arr), (src_valid, valid)):
+        reproject(source=source,
+                  destination=destination,
+                  src_transform=src_transform,
+                  src_crs=src_crs,
+                  dst_transform=transform_from_bounds(*dst_bounds, TILE_SIZE, TILE_SIZE),
+                  dst_crs='EPSG:3857',
+                  resampling=Resampling.nearest)
+    valid = valid.astype(bool)
+
+    # Colorize with the existing color tables
+    if data_type == 'float':
+        dst_arr = (dst_arr * 100).astype(np.int16)
+
+    tile = colorize_array(dst_arr, color_dict).transpose(1, 2, 0)   # CHW -> HWC
+    tile[~valid] = 0
+
+    return imageio.imwrite('<bytes>', tile, format='png')
+
+
+def _window_overlaps(window, src) -> bool:
+    """Check if a window overlaps the extent of a dataset."""
+    return (window.col_off < src.width and window.row_off < src.height and
+            window.col_off + window.width > 0 and window.row_off + window.height > 0)
+
+
+
+###################################################################
+#                         LRU tile cache                          #
+###################################################################
+
+
+class TileCache:
+    """
+    A two-level (memory + disk) LRU cache of rendered tiles, keyed by ETag.
+
+    Both levels are bounded by their total size in bytes. Tiles evicted from
+    memory stay on disk until the disk level is full as well. The disk level
+    is thread-safe, so its blocking IO can run off the event loop.
+    """
+
+    def __init__(self,
+                 mem_limit: int = 256 * 2**20,
+                 disk_dir: str = None,
+                 disk_limit: int = 2 * 2**30):
+        self.mem_limit = mem_limit
+        self.disk_dir = disk_dir
+        self.disk_limit = disk_limit
+
+        self.mem = OrderedDict()        # etag -> bytes
+        self.mem_size = 0
+        self.disk = OrderedDict()       # etag -> file size
+        self.disk_size = 0
+        self.disk_lock = threading.Lock()
+
+        # Index the existing disk cache, least recently used first
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            entries = [e for e in os.scandir(disk_dir) 
+                       if e.name.endswith('.png') and '.tmp' not in e.name]
+            for e in sorted(entries, key=lambda e: e.stat().st_mtime):
+                self.disk[e.name[:-4]] = e.stat().st_size
+                self.disk_size += e.stat().st_size
+
+    def _disk_path(self, etag: str) -> str:
+        return os.path.join(self.disk_dir, f"{etag}.png")
+
+    def get_mem(self, etag: str) -> bytes:
+        """Get a tile from memory; return None if not cached."""
+        if etag in self.mem:
+            self.mem.move_to_end(etag)
+            return self.mem[etag]
+        return None
+
+    def get_disk(self, etag: str) -> bytes:
+        """Get a tile from disk (blocking); return None if not cached."""
+        with self.disk_lock:
+            if etag not in self.disk:
+                return None
+            try:
+                with open(self._disk_path(etag), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self.disk_size -= self.disk.pop(etag)
+                return None
+            self.disk.move_to_end(etag)
+            os.utime(self._disk_path(etag))
+            return data
+
+    def put_mem(self, etag: str, data: bytes):
+        """Add a tile to memory."""
+        if etag in self.mem:
+            self.mem_size -= len(self.mem.pop(etag))
+        self.mem[etag] = data
+        self.mem_size += len(data)
+
+        while self.mem_size > self.mem_limit and len(self.mem) > 1:
+            _, old = self.mem.popitem(last=False)
+            self.mem_size -= len(old)
+
+    def put_disk(self, etag: str, data: bytes):
+        """Add a tile to disk (blocking)."""
+        if not self.disk_dir:
+            return
+
+        with self.disk_lock:
+            if etag in self.disk:
+                return
+
+            # Write to a temp file then rename, so readers never see a partial tile
+            with atomic_write_path(self._disk_path(etag)) as tmp_path:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+
+            self.disk[etag] = len(data)
+            self.disk_size += len(data)
+
+            while self.disk_size > self.disk_limit and len(self.disk) > 1:
+                old, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                try:
+                    os.remove(self._disk_path(old))
+                except FileNotFoundError:
+                    pass
+
+
+
+###################################################################
+#                       Async tile server                         #
+###################################################################
+
+
+class TileServer:
+    """
+    A local HTTP server rendering z/x/y tiles of the rasters under a root directory.
+
+    Tiles are requested as `/{z}/{x}/{y}.png?tif=<path relative to root>`, with an
+    optional `idx=<map meta row>` to pick the color table (as `map_type_idx` in
+    `process_int_raster`); otherwise the first map type found in the file name is used.
+    Rendering and disk caching run in thread pools, so concurrent viewers do not block 
+    each other. Float rasters are masked with `mask_path` as in `process_float_raster`.
+    """
+
+    def __init__(self,
+                 root: str = 'Rasters',
+                 cache: TileCache = None,
+                 workers: int = os.cpu_count(),
+                 mask_path: str = None):
+        self.root = os.path.abspath(root)
+        self.cache = cache if cache is not None else TileCache()
+        self.mask_path = mask_path
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.io_pool = ThreadPoolExecutor(max_workers=4)      # Disk cache IO, not queued behind renders
+        self.map_meta = get_map_meta()
+        self.color_dicts = {}           # csv_path -> val_color_dict
+        self.inflight = {}              # etag -> Future of the tile being rendered
+        self.disk_writes = set()        # Futures of the pending disk cache writes
+
+    def get_map_row(self, tif_path: str, idx: int = None) -> pd.Series:
+        """Get the map metadata row for a raster."""
+        if idx is not None:
+            return self.map_meta.loc[idx]
+
+        for _, row in self.map_meta.iterrows():
+            if row['map_type'] in os.path.basename(tif_path):
+                return row
+        raise KeyError(f"No map type found for '{tif_path}'")
+
+    async def get_color_dict(self, csv_path: str) -> dict:
+        """Get a color table, reading its CSV off the event loop the first time."""
+        if csv_path not in self.color_dicts:
+            loop = asyncio.get_running_loop()
+            self.color_dicts[csv_path] = await loop.run_in_executor(self.io_pool, get_val_color_dict, csv_path)
+        return self.color_dicts[csv_path]
+
+    def get_etag(self, tif_path: str, row: pd.Series, z: int, x: int, y: int) -> str:
+        """
+        Get the ETag of a tile without rendering it (blocking).
+
+        The ETag changes whenever the source raster or the color table changes.
+        Returns None if the source is not a file.
+        """
+        try:
+            st = os.stat(tif_path)
+        except FileNotFoundError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        key = f"{tif_path}|{st.st_mtime_ns}|{st.st_size}|{row['csv_path']}|{self.mask_path}|{z}/{x}/{y}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _disk_write_done(self, future):
+        """Log a failed disk cache write; the tile stays in memory only."""
+        self.disk_writes.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Failed to write a tile to the disk cache: %r", future.exception())
+
+    async def render(self, etag: str, tif_path: str, row: pd.Series, z: int, x: int, y: int) -> bytes:
+        """Get a tile from the cache, or render it once however many viewers ask for it."""
+        data = self.cache.get_mem(etag)
+        if data is not None:
+            return data
+
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self.io_pool, self.cache.get_disk, etag)
+        if data is not None:
+            self.cache.put_mem(etag, data)
+            return data
+
+        color_dict = dict(await self.get_color_dict(row['csv_path']))
+        if etag not in self.inflight:
+            self.inflight[etag] = loop.run_in_executor(self.pool,
+                                                       render_tile,
+                                                       tif_path, z, x, y,
+                                                       color_dict,
+                                                       row['data_type'],
+                                                       1,
+                                                       self.mask_path)
+        try:
+            data = await asyncio.shield(self.inflight[etag])
+        finally:
+            self.inflight.pop(etag, None)
+
+        self.cache.put_mem(etag, data)
+        write = loop.run_in_executor(self.io_pool, self.cache.put_disk, etag, data)
+        self.disk_writes.add(write)
+        write.add_done_callback(self._disk_write_done)
+        return data
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Handle a single HTTP request."""
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if line in ('\r\n', '\n', ''):
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) < 2 or request_line[0] not in ('GET', 'HEAD'):
+                await self.respond(writer, 405, b'Method Not Allowed')
+                return
+
+            method, target = request_line[0], request_line[1]
+            status, extra_headers, body = await self.route(target, headers)
+            await self.respond(writer, status, body, extra_headers, head=(method == 'HEAD'))
+
+        except Exception as e:
+            await self.respond(writer, 500, str(e).encode())
+        finally:
+            writer.close()
+
+    async def route(self, target: str, headers: dict) -> tuple:
+        """Resolve a tile request to (status, headers, body)."""
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+
+        if len(parts) != 3 or not parts[2].endswith('.png') or 'tif' not in query:
+            return 404, {}, b'Not Found'
+
+        try:
+            z, x, y = int(parts[0]), int(parts[1]), int(parts[2][:-4])
+            idx = int(query['idx'][0]) if 'idx' in query else None
+        except ValueError:
+            return 400, {}, b'Bad Request'
+
+        # Only serve rasters under the root directory
+        tif_path = os.path.abspath(os.path.join(self.root, unquote(query['tif'][0])))
+        if os.path.commonpath([tif_path, self.root]) != self.root:
+            return 404, {}, b'Not Found'
+
+        try:
+            row = self.get_map_row(tif_path, idx)
+        except KeyError:
+            return 404, {}, b'No color table for this raster'
+
+        # Stat the source off the event loop
+        loop = asyncio.get_running_loop()
+        etag = await loop.run_in_executor(self.io_pool, self.get_etag, tif_path, row, z, x, y)
+        if etag is None:
+            return 404, {}, b'Not Found'
+        tile_headers = {'ETag': f'"{etag}"',
+                        'Cache-Control': 'no-cache',
+                        'Content-Type': 'image/png'}
+
+        if headers.get('if-none-match', '').strip('"') == etag:
+            return 304, tile_headers, b''
+
+        data = await self.render(etag, tif_path, row, z, x, y)
+        return 200, tile_headers, data
+
+    async def respond(self,
+                      writer: asyncio.StreamWriter,
+                      status: int,
+                      body: bytes,
+                      headers: dict = None,
+                      head: bool = False):
+        reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+                   405: 'Method Not Allowed', 500: 'Internal Server Error'}
+        headers = {'Content-Length': str(len(body)),
+                   'Access-Control-Allow-Origin': '*',
+                   'Connection': 'close',
+                   **(headers or {})}
+
+        lines = [f"HTTP/1.1 {status} {reasons[status]}"] + [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not head and status != 304:
+            writer.write(body)
+        await writer.drain()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8000):
+        """Serve tiles until cancelled."""
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve z/x/y tiles of LUTO rasters on demand.')
+    parser.add_argument('--root', default='Rasters', help='Directory of the source rasters.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of render workers.')
+    parser.add_argument('--mem-mb', type=int, default=256, help='Memory cache limit in MB.')
+    parser.add_argument('--disk-dir', default='Rasters/tile_cache', help='Disk cache directory.')
+    parser.add_argument('--disk-mb', type=int, default=2048, help='Disk cache limit in MB.')
+    parser.add_argument('--mask', default='Assests/NLUM_2010-11_mask.tif', help='Mask for float rasters.')
+    args = parser.parse_args()
+
+    cache = TileCache(mem_limit=args.mem_mb * 2**20,
+                      disk_dir=args.disk_dir,
+                      disk_limit=args.disk_mb * 2**20)
+    server = TileServer(root=args.root, cache=cache, workers=args.workers, mask_path=args.mask)
+    asyncio.run(server.serve(args.host, args.port))